@@ -1,4 +1,4 @@
-#!/usr/bin/python
+#!/usr/bin/env python3
 #
 #  Delete the label image from an Aperio SVS file.
 #
@@ -19,11 +19,16 @@
 #  <http://www.gnu.org/licenses/>.
 #
 
-import string
+import array
+import io
 import struct
 import sys
 import os
 import argparse
+import itertools
+import mmap
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 ASCII = 2
 SHORT = 3
@@ -34,41 +39,155 @@ IMAGE_DESCRIPTION = 270
 STRIP_OFFSETS = 273
 STRIP_BYTE_COUNTS = 279
 
-class TiffFile(file):
-    def __init__(self, path):
-        file.__init__(self, path, 'r+b')
 
+def _array_typecodes():
+    # Map item size -> unsigned array.array typecode on this platform
+    typecodes = {}
+    for code in 'BHILQ':
+        typecodes.setdefault(array.array(code).itemsize, code)
+    return typecodes
+
+ARRAY_TYPECODES = _array_typecodes()
+
+# os.pwrite is not available on Windows
+_pwrite = getattr(os, 'pwrite', None)
+
+# Largest single write() when wiping
+ZERO_CHUNK = 1 << 20
+
+# Zeros shared by all wipes, grown on demand up to ZERO_CHUNK
+_ZERO_BUF = bytearray()
+
+# Read windows of closed TiffFiles, reused by the next file opened in this
+# process; windows are cut back to READ_SIZE before being pooled
+_SCRATCH_POOL = []
+
+class TiffFile(object):
+    # If the file can't be mapped, reads are served from an in-memory window
+    # of at least this many bytes
+    READ_SIZE = 65536
+    # Buffer size of the underlying file; TIFF parsing does small reads
+    FILE_BUFFERING = 8192
+    # yYzZ translation tables, indexed by whether the file is a BigTIFF
+    _TRANS = {
+        False: str.maketrans('yYzZ', 'hHiI'),
+        True: str.maketrans('yYzZ', 'qQqQ'),
+    }
+
+    def __init__(self, path):
+        self._fh = io.open(path, 'r+b', buffering=self.FILE_BUFFERING)
+        # Only the first self._buf_len bytes of self._buf are file data
+        self.mapping = self._map()
+        if self.mapping is not None:
+            # The window is the whole file, and never needs refilling
+            self._buf = self.mapping
+            self._buf_len = len(self.mapping)
+        elif _SCRATCH_POOL:
+            self._buf = _SCRATCH_POOL.pop()
+            self._buf_len = 0
+        else:
+            self._buf = bytearray(self.READ_SIZE)
+            self._buf_len = 0
+        self._buf_base = 0
+        self._pos = 0
+        try:
+            self._read_header()
+        except Exception:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self.mapping is not None:
+            self.mapping.close()
+            self.mapping = None
+        elif self._buf is not None:
+            # Don't let one large value() read pin memory for the whole batch
+            del self._buf[self.READ_SIZE:]
+            _SCRATCH_POOL.append(self._buf)
+        self._buf = None
+        self._fh.close()
+
+    def _map(self):
+        try:
+            # Read-only: writes go through write_at(), so the advice below
+            # only ever affects directory parsing
+            mm = mmap.mmap(self.fileno(), 0, access=mmap.ACCESS_READ)
+        except (EnvironmentError, ValueError, OverflowError):
+            # Empty, too large for the address space, or on a filesystem
+            # that can't be mapped (e.g. some network filesystems)
+            return None
+        if hasattr(mmap, 'MADV_RANDOM'):
+            # Directory parsing does small reads scattered through the
+            # file, for which kernel readahead is wasted
+            mm.madvise(mmap.MADV_RANDOM)
+        return mm
+
+    def flush(self):
+        self._fh.flush()
+
+    def fileno(self):
+        return self._fh.fileno()
+
+    def _read_header(self):
         # Check header, decide endianness
         endian = self.read(2)
-        if endian == 'II':
+        if endian == b'II':
             self._fmt_prefix = '<'
-        elif endian == 'MM':
+        elif endian == b'MM':
             self._fmt_prefix = '>'
         else:
             raise IOError('Not a TIFF file')
+        # Whether arrays read from the file need byteswapping
+        self.byteswap = (endian == b'II') != (sys.byteorder == 'little')
 
         # Check TIFF version
-        self._bigtiff = False
+        self._set_bigtiff(False)
         version = self.read_fmt('H')
         if version == 42:
             pass
         elif version == 43:
-            self._bigtiff = True
+            self._set_bigtiff(True)
             magic2, reserved = self.read_fmt('HH')
             if magic2 != 8 or reserved != 0:
                 raise IOError('Bad BigTIFF header')
         else:
             raise IOError('Not a TIFF file')
 
-        # Read directories
-        self.directories = []
+        # Directories are read on demand by iter_directories()
+        self._first_pointer_offset = self.tell()
+
+    def iter_directories(self):
+        # Follow the IFD chain, reading each directory only when the
+        # caller asks for it; callers may do other I/O between steps
+        in_pointer_offset = self._first_pointer_offset
         while True:
-            in_pointer_offset = self.tell()
-            directory_offset = self.read_fmt('Z')
+            self.seek(in_pointer_offset)
+            directory_offset = self._read_Z()
             if directory_offset == 0:
                 break
             self.seek(directory_offset)
-            self.directories.append(TiffDirectory(self, in_pointer_offset))
+            directory = TiffDirectory(self, in_pointer_offset)
+            yield directory
+            in_pointer_offset = directory.out_pointer_offset
+
+    @property
+    def directories(self):
+        return list(self.iter_directories())
+
+    def _set_bigtiff(self, bigtiff):
+        self._bigtiff = bigtiff
+        self._trans = self._TRANS[bigtiff]
+        # Cached Structs depend on the word sizes above
+        self._structs = {}
+        # Fixed formats read while walking the directory chain
+        self._Z = self._struct('Z')
+        self._Y = self._struct('Y')
 
     def _convert_format(self, fmt):
         # Format strings can have special characters:
@@ -76,44 +195,143 @@ class TiffFile(file):
         # Y: 16-bit unsigned on little TIFF, 64-bit unsigned on BigTIFF
         # z: 32-bit   signed on little TIFF, 64-bit   signed on BigTIFF
         # Z: 32-bit unsigned on little TIFF, 64-bit unsigned on BigTIFF
-        if self._bigtiff:
-            fmt = fmt.translate(string.maketrans('yYzZ', 'qQqQ'))
+        return self._fmt_prefix + fmt.translate(self._trans)
+
+    def _struct(self, fmt):
+        # Keyed by the unconverted format, so a hit skips the translation
+        try:
+            return self._structs[fmt]
+        except KeyError:
+            s = self._structs[fmt] = struct.Struct(self._convert_format(fmt))
+            return s
+
+    def _buffer_at(self, size):
+        # Return the index of the current position in self._buf, refilling
+        # the window from the file if it doesn't cover the next size bytes
+        if self.mapping is not None:
+            return self._pos
+        start = self._pos - self._buf_base
+        if start < 0 or start + size > self._buf_len:
+            want = max(size, self.READ_SIZE)
+            if len(self._buf) < want:
+                self._buf.extend(bytearray(want - len(self._buf)))
+            self._fh.seek(self._pos)
+            self._buf_len = self._fh.readinto(memoryview(self._buf)[:want])
+            self._buf_base = self._pos
+            start = 0
+        return start
+
+    def discard_buffer(self):
+        # A mapping reflects the file once writes have reached it (write_at
+        # never leaves them buffered), so only the window is dropped
+        if self.mapping is None:
+            self._buf_len = 0
+            self._buf_base = 0
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self._pos
+        elif whence == 2:
+            offset = self._fh.seek(offset, 2)
+        self._pos = offset
+
+    def tell(self):
+        return self._pos
+
+    def read(self, size=-1):
+        if size < 0:
+            self._fh.seek(self._pos)
+            data = self._fh.read()
         else:
-            fmt = fmt.translate(string.maketrans('yYzZ', 'hHiI'))
-        return self._fmt_prefix + fmt
+            start = self._buffer_at(size)
+            end = min(start + size, self._buf_len)
+            data = memoryview(self._buf)[start:end].tobytes()
+        self._pos += len(data)
+        return data
+
+    def write(self, data):
+        self.write_at(data, self._pos)
+        self._pos += len(data)
+
+    def write_at(self, data, offset):
+        # Positional write, independent of the current position
+        self.discard_buffer()
+        if _pwrite is None:
+            self._fh.seek(offset)
+            self._fh.write(data)
+            # Reads may come from the mapping, which can't see data still
+            # sitting in the file object's buffer
+            self._fh.flush()
+            return
+        self.flush()
+        fd = self.fileno()
+        data = memoryview(data)
+        while data:
+            n = _pwrite(fd, data, offset)
+            data = data[n:]
+            offset += n
 
     def fmt_size(self, fmt):
-        return struct.calcsize(self._convert_format(fmt))
+        return self._struct(fmt).size
+
+    def _unpack(self, s):
+        start = self._buffer_at(s.size)
+        if start + s.size > self._buf_len:
+            raise IOError('Unexpected end of file')
+        self._pos += s.size
+        return s.unpack_from(self._buf, start)
+
+    def _read_Z(self):
+        return self._unpack(self._Z)[0]
+
+    def _read_Y(self):
+        return self._unpack(self._Y)[0]
 
     def read_fmt(self, fmt, force_list=False):
-        fmt = self._convert_format(fmt)
-        vals = struct.unpack(fmt, self.read(struct.calcsize(fmt)))
+        vals = self._unpack(self._struct(fmt))
         if len(vals) == 1 and not force_list:
             return vals[0]
         else:
             return vals
 
     def write_fmt(self, fmt, *args):
-        fmt = self._convert_format(fmt)
-        self.write(struct.pack(fmt, *args))
+        self.write(self._struct(fmt).pack(*args))
 
 
 class TiffDirectory(object):
     def __init__(self, fh, in_pointer_offset):
         self.in_pointer_offset = in_pointer_offset
-        self.entries = {}
-        count = fh.read_fmt('Y')
-        for _ in range(count):
-            entry = TiffEntry(fh)
-            self.entries[entry.tag] = entry
+        self._fh = fh
+        count = fh._read_Y()
+        # Read the whole entry table at once, but only index it by tag;
+        # entries are decoded from the table when asked for
+        self._table_start = fh.tell()
+        entry_size = fh.fmt_size('HHZZ')
+        self._table = fh.read(count * entry_size)
+        if len(self._table) != count * entry_size:
+            raise IOError('Truncated directory')
+        tag_struct = fh._struct('H')
+        self.entry_offsets = {}
+        for pos in range(0, count * entry_size, entry_size):
+            tag = tag_struct.unpack_from(self._table, pos)[0]
+            self.entry_offsets[tag] = self._table_start + pos
         self.out_pointer_offset = fh.tell()
 
+    def get_entry(self, tag):
+        # Raises KeyError if the directory has no such tag
+        start = self.entry_offsets[tag]
+        fields = self._fh._struct('HHZZ').unpack_from(self._table,
+                start - self._table_start)
+        return TiffEntry(self._fh, start, *fields)
+
 
 class TiffEntry(object):
-    def __init__(self, fh):
-        self.start = fh.tell()
-        self.tag, self.type, self.count, self.value_offset = \
-                fh.read_fmt('HHZZ')
+    def __init__(self, fh, start, tag, entry_type, count, value_offset):
+        self.start = start
+        self.tag = tag
+        self.type = entry_type
+        self.count = count
+        self.value_offset = value_offset
         self._fh = fh
 
     def value(self):
@@ -128,30 +346,76 @@ class TiffEntry(object):
         else:
             raise ValueError('Unsupported type')
 
-        fmt = '%d%s' % (self.count, item_fmt)
-        len = self._fh.fmt_size(fmt)
+        item_size = self._fh.fmt_size(item_fmt)
+        len = self.count * item_size
         if len <= self._fh.fmt_size('Z'):
             # Inline value
             self._fh.seek(self.start + self._fh.fmt_size('HHZ'))
         else:
             # Out-of-line value
             self._fh.seek(self.value_offset)
-        items = self._fh.read_fmt(fmt, force_list=True)
+        data = self._fh.read(len)
         if self.type == ASCII:
-            if items[-1] != '\0':
+            if data[-1:] != b'\0':
                 raise ValueError('String not null-terminated')
-            return ''.join(items[:-1])
+            return data[:-1].decode('latin-1')
+        try:
+            items = array.array(ARRAY_TYPECODES[item_size], data)
+        except KeyError:
+            # No array type of this width; unpack item by item
+            return self._fh._struct('%d%s' % (self.count, item_fmt)).unpack(data)
+        if self._fh.byteswap:
+            items.byteswap()
+        return items
+
+
+def coalesce_strips(offsets, lengths):
+    # Merge strips that are adjacent (or overlapping) in the file into
+    # (offset, length) runs, so each run can be wiped in one go
+    runs = []
+    for offset, length in sorted(zip(offsets, lengths)):
+        if length <= 0:
+            continue
+        if runs and offset <= runs[-1][0] + runs[-1][1]:
+            run_offset, run_length = runs[-1]
+            runs[-1] = (run_offset,
+                    max(run_length, offset + length - run_offset))
         else:
-            return items
+            runs.append((offset, length))
+    return runs
+
+
+def write_zeros(fh, offset, length):
+    size = min(length, ZERO_CHUNK)
+    if len(_ZERO_BUF) < size:
+        _ZERO_BUF.extend(bytearray(size - len(_ZERO_BUF)))
+    zeros = memoryview(_ZERO_BUF)
+    while length > 0:
+        n = min(length, len(zeros))
+        fh.write_at(zeros[:n], offset)
+        offset += n
+        length -= n
+
+
+def wipe_strips(fh, offsets, lengths):
+    # Zero each run of strips with positional writes from the shared zero
+    # buffer.  Writing through the mapping would fault every page in from
+    # disk first, which is much slower on a cold cache.
+    runs = coalesce_strips(offsets, lengths)
+    for offset, length in runs:
+        write_zeros(fh, offset, length)
+    # No msync or io_uring-style batched submission here: the zeroed
+    # pages go to normal kernel writeback, so nothing waits on the device
+    return sum(l for _, l in runs)
 
 
 def delete_aperio_label(filename, delete_entry=True):
-    write_size = 0
+    # Returns the number of label bytes overwritten
     with TiffFile(filename) as fh:
-        for directory in fh.directories:
+        for directory in fh.iter_directories():
             # Check ImageDescription
             try:
-                desc = directory.entries[IMAGE_DESCRIPTION].value()
+                desc = directory.get_entry(IMAGE_DESCRIPTION).value()
             except KeyError:
                 continue
             if not desc.startswith('Aperio'):
@@ -164,34 +428,82 @@ def delete_aperio_label(filename, delete_entry=True):
 
             # Get strip offsets/lengths
             try:
-                offsets = directory.entries[STRIP_OFFSETS].value()
-                lengths = directory.entries[STRIP_BYTE_COUNTS].value()
+                offsets = directory.get_entry(STRIP_OFFSETS).value()
+                lengths = directory.get_entry(STRIP_BYTE_COUNTS).value()
             except KeyError:
-                print(lines)
                 raise IOError('Label is not stripped')
 
             # Wipe strips
-            for offset, length in zip(offsets, lengths):
-                fh.seek(offset)
-                fh.write('\0' * length)
-                write_size += sys.getsizeof('\0' * length)
+            write_size = wipe_strips(fh, offsets, lengths)
 
             # Delete directory
-            fh.seek(directory.out_pointer_offset)
-            out_pointer = fh.read_fmt('Z')
-            fh.seek(directory.in_pointer_offset)
             if delete_entry:
+                fh.seek(directory.out_pointer_offset)
+                out_pointer = fh.read_fmt('Z')
+                fh.seek(directory.in_pointer_offset)
                 fh.write_fmt('Z', out_pointer)
-            print "Wrote " + str(write_size) + " bytes (" + str(write_size / 1000) + " kb)"
             # Done
-            break
-        else:
-            raise IOError("Couldn't find Aperio label directory")
+            return write_size
+        raise IOError("Couldn't find Aperio label directory")
+
+
+def positive_int(value):
+    # argparse type for counts that must be at least 1
+    try:
+        n = int(value)
+    except ValueError:
+        n = 0
+    if n < 1:
+        raise argparse.ArgumentTypeError("must be a positive integer: %r" % value)
+    return n
+
+
+def iter_folder(folder):
+    # Yield slides as the directory is scanned, so the first ones can be
+    # processed before the listing is complete
+    with os.scandir(folder) as it:
+        for entry in it:
+            if entry.name.endswith(".svs") and entry.is_file():
+                yield entry.path
+
+
+def iter_manifest(manifest_path):
+    with open(manifest_path, "r") as manifest:
+        for line in manifest:
+            if line.strip().endswith(".svs"):
+                yield line.strip()
+
+
+def collect_paths(args):
+    # Slides named on the command line, followed by those in the folder
+    # or manifest, if one was given
+    paths = (path for path in args.slides if path.endswith(".svs"))
+    if args.folder is not None:
+        return itertools.chain(paths, iter_folder(args.folder))
+    if args.manifest is not None:
+        return itertools.chain(paths, iter_manifest(args.manifest))
+    return paths
+
+
+def _wipe_one(filename, delete_entry):
+    # Pool worker; errors are returned rather than raised so the parent
+    # can report every file in order
+    try:
+        return filename, delete_aperio_label(filename, delete_entry), None
+    except Exception as e:
+        return filename, 0, e
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
 
+    parser.add_argument(
+        "slides",
+        help=".svs files to anonymize",
+        nargs="*",
+        default=[]
+    )
+
     parser.add_argument(
         "-manifest",
         "-m",
@@ -216,53 +528,59 @@ if __name__ == '__main__':
 
     )
 
-    if len(sys.argv) <= 1:
-        print("You need some arguments")
-        print("Either enter a manifest of file paths (-m), or point to a folder (-f) containing all slides you want anonymized")
-        print("Alternatively, list all .svs files sequentally")
-        print("... I feel like this is too many options")
-        exit(1)
-
-    paths = []
-    if str(sys.argv[1]) is not None and str(sys.argv[1]).endswith(".svs"):
-        for arg in sys.argv[1:]:
-            if str(arg.endswith(".svs")):
-                paths.append(arg)
-
+    parser.add_argument(
+        "-jobs",
+        "-j",
+        help="number of slides to process in parallel (default: one per CPU)",
+        type=positive_int,
+        default=None
+    )
 
-    args = parser.parse_args()
+    # Slides may be given before and after options
+    args = parser.parse_intermixed_args()
     if args.folder is not None and args.manifest is not None:
         print("Please enter only a manifest or a folder, not both")
         exit(1)
 
-    if args.folder is not None:
-        if not str(args.folder).endswith("/"):
-            args.folder += "/"
-        for path in os.listdir(args.folder):
-            if path.endswith(".svs"):
-                paths.append(args.folder + path)
-
-    elif args.manifest is not None:
-        with open(args.manifest, "r") as manifest:
-            for line in manifest:
-                if line.strip().endswith(".svs"):
-                    paths.append(line.strip())
-
-    else:
+    if not args.slides and args.folder is None and args.manifest is None:
         print("You need some arguments")
         print("Either enter a manifest of file paths (-m), or point to a folder (-f) containing all slides you want anonymized")
         print("Alternatively, list all .svs files sequentally")
         print("... I feel like this is too many options")
         exit(1)
 
+    paths = collect_paths(args)
+
+    # Every path handed to the pool, so the ones without a result can be
+    # reported if a worker dies
+    submitted = []
+
+    def submit(paths):
+        for filename in paths:
+            submitted.append(filename)
+            yield filename
+
     exit_code = 0
-    for filename in paths:
-        print("\n" + filename)
-        try:
-            delete_aperio_label(filename, args.remove_header)
-        except Exception as e:
-            print "Could not strip label from " + filename
-            exit_code = 1
+    reported = 0
+    try:
+        with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+            results = executor.map(_wipe_one, submit(paths),
+                    itertools.repeat(args.remove_header))
+            for filename, write_size, e in results:
+                reported += 1
+                print("\n" + filename)
+                if e is None:
+                    print("Wrote " + str(write_size) + " bytes (" + str(write_size // 1000) + " kb)")
+                else:
+                    print("Could not strip label from " + filename)
+                    exit_code = 1
+    except BrokenProcessPool:
+        # A worker was killed (e.g. SIGBUS on a truncated slide, or the OOM
+        # killer); the remaining results are lost
+        for filename in submitted[reported:]:
+            print("\n" + filename)
+            print("Label may not have been stripped from " + filename + " (worker process died)")
+        exit_code = 1
     sys.exit(exit_code)
 
 
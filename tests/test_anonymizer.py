@@ -0,0 +1,202 @@
+import argparse
+import os
+import struct
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import anonymizer  # noqa: E402
+
+STRIP_LENGTH = 3000
+STRIPS = 4
+
+
+def make_svs(path, prefix='<', bigtiff=False):
+    # Write a small Aperio-style slide with main, label and macro IFDs,
+    # each stored as STRIPS strips.  Returns the label's (offset, length)
+    # strips.
+    Z = 'Q' if bigtiff else 'I'
+    Y = 'Q' if bigtiff else 'H'
+    data = bytearray(b'II' if prefix == '<' else b'MM')
+    if bigtiff:
+        data += struct.pack(prefix + 'HHH', 43, 8, 0)
+    else:
+        data += struct.pack(prefix + 'H', 42)
+    pointer = len(data)
+    data += struct.pack(prefix + Z, 0)
+    label = None
+    for i, kind in enumerate(['main 1000x1000', 'label 387x463', 'macro 1x1']):
+        offsets = []
+        for s in range(STRIPS):
+            offsets.append(len(data))
+            data += bytes([i * STRIPS + s + 1]) * STRIP_LENGTH
+        if kind.startswith('label'):
+            label = [(o, STRIP_LENGTH) for o in offsets]
+        desc = b'Aperio Image Library v12.0.5\r\n' + kind.encode() + b'\0'
+        desc_offset = len(data)
+        data += desc
+        offsets_offset = len(data)
+        data += struct.pack(prefix + '%d%s' % (STRIPS, Z), *offsets)
+        counts_offset = len(data)
+        data += struct.pack(prefix + '%d%s' % (STRIPS, Z),
+                *([STRIP_LENGTH] * STRIPS))
+        if len(data) % 2:
+            data += b'\0'
+        data[pointer:pointer + struct.calcsize(Z)] = \
+                struct.pack(prefix + Z, len(data))
+        strip_type = anonymizer.LONG8 if bigtiff else anonymizer.LONG
+        entries = [
+            (anonymizer.IMAGE_DESCRIPTION, anonymizer.ASCII, len(desc),
+                    desc_offset),
+            (anonymizer.STRIP_OFFSETS, strip_type, STRIPS, offsets_offset),
+            (anonymizer.STRIP_BYTE_COUNTS, strip_type, STRIPS, counts_offset),
+        ]
+        data += struct.pack(prefix + Y, len(entries))
+        for entry in entries:
+            data += struct.pack(prefix + 'HH' + Z + Z, *entry)
+        pointer = len(data)
+        data += struct.pack(prefix + Z, 0)
+    with open(path, 'wb') as fh:
+        fh.write(data)
+    return label
+
+
+def descriptions(path):
+    with anonymizer.TiffFile(path) as fh:
+        return [d.get_entry(anonymizer.IMAGE_DESCRIPTION).value()
+                for d in fh.iter_directories()]
+
+
+# Small enough that tag values outgrow the read window
+SMALL_READ_SIZE = 32
+
+
+@pytest.fixture(params=[
+    (True, True), (True, False), (False, True), (False, False)],
+    ids=['mmap-pwrite', 'mmap-write', 'window-pwrite', 'window-write'])
+def io_path(request, monkeypatch):
+    # Run on each combination of the mmap / buffered-window read paths and
+    # the os.pwrite / seek + write write paths.  Returns whether the file
+    # is mapped.
+    mapped, pwrite = request.param
+    if not mapped:
+        monkeypatch.setattr(anonymizer.TiffFile, '_map', lambda self: None)
+        monkeypatch.setattr(anonymizer.TiffFile, 'READ_SIZE', SMALL_READ_SIZE)
+        monkeypatch.setattr(anonymizer, '_SCRATCH_POOL', [])
+    if not pwrite:
+        monkeypatch.setattr(anonymizer, '_pwrite', None)
+    return mapped
+
+
+@pytest.mark.parametrize('prefix', ['<', '>'])
+@pytest.mark.parametrize('bigtiff', [False, True])
+@pytest.mark.parametrize('delete_entry', [False, True])
+def test_delete_aperio_label(tmp_path, io_path, prefix, bigtiff,
+        delete_entry):
+    path = str(tmp_path / 'slide.svs')
+    label = make_svs(path, prefix, bigtiff)
+    with open(path, 'rb') as fh:
+        before = fh.read()
+
+    # Read a value larger than the window from another slide first, so
+    # the unmapped path grows a window, pools it and reuses it below
+    other = str(tmp_path / 'other.svs')
+    make_svs(other, prefix, bigtiff)
+    assert len(descriptions(other)[0]) > SMALL_READ_SIZE
+
+    written = anonymizer.delete_aperio_label(path, delete_entry)
+
+    assert written == STRIPS * STRIP_LENGTH
+    with open(path, 'rb') as fh:
+        after = fh.read()
+    assert len(after) == len(before)
+    for offset, length in label:
+        assert after[offset:offset + length] == b'\0' * length
+    # Outside the label, at most the pointer to the label IFD changes
+    wiped = set(i for o, l in label for i in range(o, o + l))
+    changed = [i for i in range(len(after))
+            if after[i] != before[i] and i not in wiped]
+    assert len(changed) <= (8 if bigtiff else 4) * delete_entry
+    kinds = [d.splitlines()[1].split()[0] for d in descriptions(path)]
+    if delete_entry:
+        assert kinds == ['main', 'macro']
+    else:
+        assert kinds == ['main', 'label', 'macro']
+    if not io_path:
+        # One window served every file and was shrunk back each time
+        assert [len(b) for b in anonymizer._SCRATCH_POOL] == [SMALL_READ_SIZE]
+
+
+def test_write_then_read_back(tmp_path, io_path):
+    path = str(tmp_path / 'slide.svs')
+    make_svs(path)
+    with anonymizer.TiffFile(path) as fh:
+        fh.seek(4)
+        fh.write_fmt('I', 1234)
+        fh.seek(4)
+        assert fh.read_fmt('I') == 1234
+
+
+def test_delete_aperio_label_without_label(tmp_path):
+    path = str(tmp_path / 'slide.svs')
+    make_svs(path)
+    anonymizer.delete_aperio_label(path, True)
+    with pytest.raises(IOError):
+        anonymizer.delete_aperio_label(path, True)
+
+
+def test_reports_once_per_file(tmp_path):
+    paths = [str(tmp_path / name) for name in ('a.svs', 'b.svs')]
+    for path in paths:
+        make_svs(path)
+    result = subprocess.run(
+        [sys.executable, os.path.join(ROOT, 'anonymizer.py'), '-j', '1']
+        + paths, stdout=subprocess.PIPE, universal_newlines=True)
+    assert result.returncode == 0
+    wrote = [l for l in result.stdout.splitlines() if l.startswith('Wrote')]
+    assert wrote == ['Wrote %d bytes (%d kb)' % (STRIPS * STRIP_LENGTH,
+            STRIPS * STRIP_LENGTH // 1000)] * 2
+
+
+def test_slides_around_options(tmp_path):
+    paths = [str(tmp_path / name) for name in ('a.svs', 'b.svs')]
+    for path in paths:
+        make_svs(path)
+    result = subprocess.run(
+        [sys.executable, os.path.join(ROOT, 'anonymizer.py'), paths[0],
+                '-j', '1', paths[1]],
+        stdout=subprocess.PIPE, universal_newlines=True)
+    assert result.returncode == 0
+    assert [l for l in result.stdout.splitlines() if l.endswith('.svs')] == \
+            paths
+
+
+def args(slides=(), folder=None, manifest=None):
+    return argparse.Namespace(slides=list(slides), folder=folder,
+            manifest=manifest)
+
+
+def test_collect_paths_positional():
+    paths = anonymizer.collect_paths(args(['a.svs', 'notes.txt', 'b.svs']))
+    assert list(paths) == ['a.svs', 'b.svs']
+
+
+def test_collect_paths_folder(tmp_path):
+    for name in ('a.svs', 'b.svs', 'c.txt'):
+        (tmp_path / name).write_bytes(b'')
+    (tmp_path / 'dir.svs').mkdir()
+    paths = anonymizer.collect_paths(args(['x.svs'], folder=str(tmp_path)))
+    assert list(paths)[0] == 'x.svs'
+    assert sorted(anonymizer.collect_paths(args(folder=str(tmp_path)))) == \
+            [str(tmp_path / 'a.svs'), str(tmp_path / 'b.svs')]
+
+
+def test_collect_paths_manifest(tmp_path):
+    manifest = tmp_path / 'manifest.csv'
+    manifest.write_text(' /data/a.svs \nnotes.txt\n/data/b.svs\n')
+    paths = anonymizer.collect_paths(args(manifest=str(manifest)))
+    assert list(paths) == ['/data/a.svs', '/data/b.svs']